@@ -2,21 +2,44 @@ import os
 import json
 import uuid
 import io
+import math
 import zipfile
 import shutil
-from typing import List
+import itertools
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
 
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse
+import aiofiles
+from fastapi import FastAPI, File, Form, Query, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse, HTMLResponse
+import numpy as np
+import pikepdf
 from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
 
 # --- Configuración Inicial ---
 load_dotenv()
 
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    """Levanta el pool de procesos al iniciar la aplicación y lo cierra al apagarla."""
+    obtener_executor()
+    yield
+    cerrar_executor()
+
+
 app = FastAPI(
     title="API de Generación de Certificados",
-    description="Un servicio para crear plantillas y generar lotes de certificados en PDF."
+    description="Un servicio para crear plantillas y generar lotes de certificados en PDF.",
+    lifespan=ciclo_de_vida
 )
 
 # --- Definición de Carpetas ---
@@ -28,6 +51,202 @@ os.makedirs(CARPETA_GENERADOS, exist_ok=True)
 os.makedirs(CARPETA_PLANTILLAS_CONFIG, exist_ok=True)
 os.makedirs(CARPETA_FUENTES, exist_ok=True)
 
+TAMANO_BLOQUE_SUBIDA = 1024 * 1024
+
+
+# --- Renderizado en Paralelo ---
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def obtener_executor() -> ProcessPoolExecutor:
+    """Devuelve el pool de procesos compartido, creándolo si todavía no existe."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # forkserver evita heredar hilos y locks del proceso de uvicorn en los workers.
+            _executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _executor
+
+
+def descartar_executor(executor: ProcessPoolExecutor) -> None:
+    """Descarta un pool roto para que la siguiente petición cree uno nuevo."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def cerrar_executor() -> None:
+    """Apaga el pool de procesos compartido, si existe."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+
+
+def mapear_en_pool(funcion: Callable[[Any], Any], argumentos: Iterable[Any]) -> Iterator[Any]:
+    """Ejecuta funcion sobre argumentos en el pool, en orden y con un número acotado de tareas en vuelo.
+
+    Solo se mantienen 2 * CPUs tareas enviadas a la vez, así los resultados no se acumulan en memoria
+    cuando el consumidor (p. ej. un cliente lento) va más despacio que los workers. Si algún worker
+    muere se descarta el pool para que la siguiente petición cree uno nuevo.
+    """
+    executor = obtener_executor()
+    ventana = 2 * (os.cpu_count() or 1)
+    pendientes = deque()
+    try:
+        for argumento in argumentos:
+            pendientes.append(executor.submit(funcion, argumento))
+            if len(pendientes) >= ventana:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
+    except BrokenProcessPool:
+        descartar_executor(executor)
+        raise
+    finally:
+        for futuro in pendientes:
+            futuro.cancel()
+
+
+COLOR_TEXTO = np.array((0, 0, 0), dtype=np.float32)
+OPCIONES_PDF = {"resolution": 100.0, "quality": 75, "optimize": True}
+MEDIDOR_TEXTO = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+
+@lru_cache(maxsize=16)
+def cargar_plantilla(plantilla_id: str) -> Tuple[np.ndarray, ImageFont.FreeTypeFont, dict]:
+    """Lee la configuración, decodifica el fondo y carga la fuente una sola vez por proceso y por plantilla."""
+    ruta_plantilla = os.path.join(CARPETA_PLANTILLAS_CONFIG, plantilla_id)
+    with open(os.path.join(ruta_plantilla, "config.json"), 'r') as f:
+        config = json.load(f)
+
+    fondo = np.array(Image.open(os.path.join(ruta_plantilla, "fondo.png")).convert("RGB"))
+    ruta_fuente = os.path.join(ruta_plantilla, config["nombre_archivo_fuente"])
+    fuente = ImageFont.truetype(ruta_fuente, config["tamano_fuente"])
+    return fondo, fuente, config
+
+
+def componer_texto(
+    lienzo: np.ndarray, nombre: str, fuente: ImageFont.FreeTypeFont, y_coord: int
+) -> Optional[Tuple[Tuple[slice, slice], np.ndarray]]:
+    """Dibuja el nombre centrado horizontalmente sobre el lienzo RGB, mezclando solo la región del texto.
+
+    Devuelve la ventana modificada junto con una copia de su contenido original para poder restaurarla.
+    """
+    alto_imagen, ancho_imagen = lienzo.shape[:2]
+    # textbbox (y no fuente.getbbox) para medir igual que ImageDraw.text, incluidos los nombres de varias líneas.
+    izquierda, arriba, derecha, abajo = MEDIDOR_TEXTO.textbbox((0, 0), nombre, font=fuente)
+    x_coord = (ancho_imagen - (derecha - izquierda)) / 2
+
+    # Igual que ImageDraw.text: la parte entera de x posiciona la máscara y la fraccionaria se pasa al rasterizado.
+    fraccion, entero = math.modf(x_coord)
+    margen_x, margen_y = max(0, -izquierda), max(0, -arriba)
+    x0, y0 = int(entero) - margen_x, y_coord - margen_y
+    ancho_mascara, alto_mascara = derecha + margen_x + 1, abajo + margen_y
+
+    x1, y1 = max(x0, 0), max(y0, 0)
+    x2, y2 = min(x0 + ancho_mascara, ancho_imagen), min(y0 + alto_mascara, alto_imagen)
+    if x1 >= x2 or y1 >= y2:
+        return None
+
+    mascara = Image.new("L", (ancho_mascara, alto_mascara), 0)
+    ImageDraw.Draw(mascara).text((margen_x + fraccion, margen_y), nombre, font=fuente, fill=255)
+    alfa = np.asarray(mascara, dtype=np.float32)[y1 - y0:y2 - y0, x1 - x0:x2 - x0, None] / 255.0
+
+    ventana = (slice(y1, y2), slice(x1, x2))
+    region = lienzo[ventana]
+    original = region.copy()
+    region[...] = (region * (1.0 - alfa) + COLOR_TEXTO * alfa + 0.5).astype(np.uint8)
+    return ventana, original
+
+
+def render_one(args: Tuple[str, str]) -> Tuple[str, bytes]:
+    """Renderiza el certificado de un nombre y devuelve (nombre, bytes del PDF).
+
+    El texto se compone directamente sobre el fondo en caché y solo se restaura la ventana modificada,
+    evitando copiar la imagen completa en cada nombre.
+    """
+    plantilla_id, nombre = args
+    fondo, fuente, config = cargar_plantilla(plantilla_id)
+
+    modificado = componer_texto(fondo, nombre, fuente, config["y_coord"])
+    try:
+        pdf_buffer = io.BytesIO()
+        Image.fromarray(fondo).save(pdf_buffer, "PDF", **OPCIONES_PDF)
+    finally:
+        if modificado is not None:
+            ventana, original = modificado
+            fondo[ventana] = original
+    return nombre, pdf_buffer.getvalue()
+
+
+class SalidaZip(io.RawIOBase):
+    """Destino no posicionable para ZipFile que acumula bytes hasta que se vacían hacia el cliente."""
+
+    def __init__(self):
+        super().__init__()
+        self._pendiente = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        self._pendiente.extend(datos)
+        return len(datos)
+
+    def vaciar(self) -> bytes:
+        datos = bytes(self._pendiente)
+        self._pendiente.clear()
+        return datos
+
+
+def generar_zip(argumentos: List[Tuple[str, str]]) -> Iterator[bytes]:
+    """Produce el ZIP por partes, enviando cada certificado en cuanto el pool lo termina."""
+    salida = SalidaZip()
+    with zipfile.ZipFile(salida, "w", zipfile.ZIP_STORED) as zip_file:
+        for nombre, pdf_bytes in mapear_en_pool(render_one, argumentos):
+            nombre_archivo_pdf = f"certificado_{nombre.replace(' ', '_')}.pdf"
+            zip_file.writestr(nombre_archivo_pdf, pdf_bytes)
+            yield salida.vaciar()
+    yield salida.vaciar()
+
+
+def generar_pdf_unico(argumentos: List[Tuple[str, str]]) -> bytes:
+    """Genera un único PDF con una página por nombre, uniendo los PDF que codifican los workers."""
+    documento = pikepdf.Pdf.new()
+    # qpdf lee el contenido de las páginas copiadas al guardar, así que los PDF de origen deben seguir abiertos.
+    origenes = []
+    try:
+        for _, pdf_bytes in mapear_en_pool(render_one, argumentos):
+            origen = pikepdf.Pdf.open(io.BytesIO(pdf_bytes))
+            origenes.append(origen)
+            documento.pages.extend(origen.pages)
+
+        pdf_buffer = io.BytesIO()
+        documento.save(pdf_buffer)
+    finally:
+        for origen in origenes:
+            origen.close()
+        documento.close()
+    return pdf_buffer.getvalue()
+
+
+# --- Manejo de Archivos Subidos ---
+
+async def guardar_subida(archivo: UploadFile, ruta_destino: str) -> None:
+    """Copia un archivo subido a disco por bloques sin bloquear el event loop."""
+    async with aiofiles.open(ruta_destino, "wb") as destino:
+        while bloque := await archivo.read(TAMANO_BLOQUE_SUBIDA):
+            await destino.write(bloque)
+
 
 # --- Endpoints de la API ---
 
@@ -54,18 +273,16 @@ async def crear_plantilla_certificado(
     if not fuente_ttf.filename.lower().endswith(('.ttf', '.otf')):
         raise HTTPException(status_code=400, detail="El archivo de fuente debe ser .TTF o .OTF.")
 
-    plantilla_id = str(uuid.uuid4())
+    plantilla_id = uuid.uuid4().hex
     ruta_plantilla = os.path.join(CARPETA_PLANTILLAS_CONFIG, plantilla_id)
     os.makedirs(ruta_plantilla)
 
     try:
         ruta_png = os.path.join(ruta_plantilla, "fondo.png")
-        with open(ruta_png, "wb") as buffer:
-            buffer.write(await plantilla_png.read())
+        await guardar_subida(plantilla_png, ruta_png)
 
         ruta_fuente = os.path.join(ruta_plantilla, fuente_ttf.filename)
-        with open(ruta_fuente, "wb") as buffer:
-            buffer.write(await fuente_ttf.read())
+        await guardar_subida(fuente_ttf, ruta_fuente)
 
         config = {
             "y_coord": y_coord,
@@ -73,8 +290,8 @@ async def crear_plantilla_certificado(
             "nombre_archivo_fuente": fuente_ttf.filename
         }
         ruta_config = os.path.join(ruta_plantilla, "config.json")
-        with open(ruta_config, "w") as f:
-            json.dump(config, f)
+        async with aiofiles.open(ruta_config, "w") as f:
+            await f.write(json.dumps(config))
 
         return {"message": "Plantilla creada exitosamente.", "plantilla_id": plantilla_id}
     except Exception as e:
@@ -86,9 +303,12 @@ async def crear_plantilla_certificado(
 @app.post("/generar-certificados", tags=["Flujo de Certificados"])
 async def generar_certificados(
     plantilla_id: str = Form(..., description="El ID de la plantilla creada previamente."),
-    nombres: List[str] = Form(..., description="Lista de nombres para generar los certificados.")
+    nombres: List[str] = Form(..., description="Lista de nombres para generar los certificados."),
+    formato: str = Query("zip", description="'zip' para un PDF por nombre, 'single_pdf' para un único PDF de varias páginas.")
 ):
-    """Paso 2: Usa el ID de la plantilla y una lista de nombres para generar los PDFs en un ZIP."""
+    """Paso 2: Usa el ID de la plantilla y una lista de nombres para generar los PDFs en un ZIP o en un único PDF."""
+    if formato not in ("zip", "single_pdf"):
+        raise HTTPException(status_code=400, detail="El formato debe ser 'zip' o 'single_pdf'.")
     ruta_plantilla = os.path.join(CARPETA_PLANTILLAS_CONFIG, plantilla_id)
     if not os.path.isdir(ruta_plantilla):
         raise HTTPException(status_code=404, detail="El ID de la plantilla no fue encontrado.")
@@ -99,31 +319,25 @@ async def generar_certificados(
         
         ruta_png = os.path.join(ruta_plantilla, "fondo.png")
         ruta_fuente = os.path.join(ruta_plantilla, config["nombre_archivo_fuente"])
-        fuente = ImageFont.truetype(ruta_fuente, config["tamano_fuente"])
-        
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for nombre in nombres:
-                imagen_base = Image.open(ruta_png).convert("RGB")
-                dibujo = ImageDraw.Draw(imagen_base)
-                
-                ancho_imagen, _ = imagen_base.size
-                bbox = dibujo.textbbox((0, 0), nombre, font=fuente)
-                ancho_texto = bbox[2] - bbox[0]
-                x_coord = (ancho_imagen - ancho_texto) / 2
-                
-                dibujo.text((x_coord, config["y_coord"]), nombre, font=fuente, fill=(0, 0, 0))
-
-                pdf_buffer = io.BytesIO()
-                imagen_base.save(pdf_buffer, "PDF", resolution=100.0)
-                pdf_buffer.seek(0)
-                
-                nombre_archivo_pdf = f"certificado_{nombre.replace(' ', '_')}.pdf"
-                zip_file.writestr(nombre_archivo_pdf, pdf_buffer.read())
-
-        zip_buffer.seek(0)
+        if not os.path.isfile(ruta_png) or not os.path.isfile(ruta_fuente):
+            raise FileNotFoundError(ruta_plantilla)
+
+        argumentos = [(plantilla_id, nombre) for nombre in nombres]
+
+        if formato == "single_pdf":
+            pdf_bytes = await run_in_threadpool(generar_pdf_unico, argumentos)
+            return Response(
+                content=pdf_bytes,
+                media_type="application/pdf",
+                headers={"Content-Disposition": f"attachment; filename=certificados_{plantilla_id}.pdf"}
+            )
+
+        # Se genera el primer certificado antes de responder: una vez enviadas las cabeceras ya no se
+        # puede devolver un error HTTP, y así un fondo, fuente o config.json inválidos siguen dando 500.
+        partes = generar_zip(argumentos)
+        primera_parte = await run_in_threadpool(next, partes)
         return StreamingResponse(
-            zip_buffer,
+            itertools.chain([primera_parte], partes),
             media_type="application/zip",
             headers={"Content-Disposition": f"attachment; filename=certificados_{plantilla_id}.zip"}
         )